@@ -0,0 +1,30 @@
+from sqlalchemy import text
+from backend.models import engine
+
+INDEXES = (
+    ("ix_users_referrer_self", "users (referrer_id, self_activated)"),
+    ("ix_users_role_active", "users (self_activated, role)"),
+)
+
+# Covered by a leading column of one of the above
+DROPPED_INDEXES = ("ix_users_referrer_id",)
+
+def main():
+    print("=== CONNECTING TO DB ===")
+    print("DB URL:", engine.url)
+
+    with engine.connect() as conn:
+        for name, target in INDEXES:
+            print(f"Creating {name}...")
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {target};"))
+
+        for name in DROPPED_INDEXES:
+            print(f"Dropping {name}...")
+            conn.execute(text(f"DROP INDEX IF EXISTS {name};"))
+
+        conn.commit()
+
+    print("=== DONE ===")
+
+if __name__ == "__main__":
+    main()
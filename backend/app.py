@@ -1,16 +1,25 @@
 import os
 import logging
 import traceback
-import json
 import time
-from urllib.parse import parse_qsl
+import hmac
+import hashlib
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_plus
 from datetime import datetime
 from typing import Optional
-from sqlalchemy import text
+from sqlalchemy import BigInteger, Integer, bindparam, case, column, func, select, text, update
 
-from flask import Flask, request, jsonify, send_from_directory, current_app
+from flask import Flask, Request, request, jsonify, send_from_directory, current_app, g, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.exc import SQLAlchemyError
+import orjson
+from whitenoise import WhiteNoise
 import requests
 from dotenv import load_dotenv
 from sqlalchemy.exc import OperationalError
@@ -32,17 +41,97 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+
 # Now it is safe to log
 logger.info(
     "BOT_TOKEN loaded: %s",
-    "YES" if os.getenv("BOT_TOKEN") else "NO"
+    "YES" if BOT_TOKEN else "NO"
+)
+
+# Key Telegram signs WebApp initData with: HMAC_SHA256("WebAppData", token).
+# The token is fixed for the life of the process, so derive it once here
+# rather than on every verify_telegram_init_data() call (see
+# _refresh_secret_key() for rotating it).
+_TELEGRAM_SECRET_KEY = (
+    hmac.new(b"WebAppData", BOT_TOKEN.encode(), hashlib.sha256).digest()
+    if BOT_TOKEN else None
 )
+if _TELEGRAM_SECRET_KEY is None:
+    logger.warning("BOT_TOKEN not set: initData signatures will NOT be checked")
 # -------------------------
 # Flask app creation
 # -------------------------
+class OrjsonProvider(DefaultJSONProvider):
+    """jsonify()/get_json() via orjson; Flask's default() still handles Decimal, UUID, etc."""
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get("sort_keys", self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get("indent"):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        # also backs request.get_json(); orjson's decode error is a ValueError
+        return orjson.loads(s)
+
+
+# A Telegram update carrying a long message (4096 characters plus entities)
+# can pass 16 KiB, so /webhook gets more room than the app-wide cap.
+WEBHOOK_MAX_CONTENT_LENGTH = 1024 * 1024
+
+
+class AppRequest(Request):
+    @property
+    def max_content_length(self):
+        if self.path == "/webhook":
+            return WEBHOOK_MAX_CONTENT_LENGTH
+        return super().max_content_length
+
+
 app = Flask(__name__)
+app.request_class = AppRequest
+app.json = OrjsonProvider(app)
 CORS(app)
 
+# /webapp/* and /admin/* bodies are small JSON objects; anything larger is
+# rejected by Werkzeug with 413 before the body is read.
+app.config["MAX_CONTENT_LENGTH"] = 16 * 1024
+
+# Let browsers / Telegram's webview reuse /static/* (the mini app) for five
+# minutes; revalidation with If-None-Match is answered with 304.
+app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 300
+
+# WhiteNoise intercepts /static/* before Flask's built-in static view is
+# reached (headers computed once at startup, sendfile via the server's
+# file_wrapper); that view only still serves files added after startup.
+app.wsgi_app = WhiteNoise(
+    app.wsgi_app,
+    root=app.static_folder,
+    prefix="static/",
+    max_age=app.config["SEND_FILE_MAX_AGE_DEFAULT"],
+)
+
+# Telegram initData is well under 4 KiB
+MAX_INIT_DATA_LENGTH = 8192
+
+
+def get_db():
+    """Session for the current request, opened on first use."""
+    if "db" not in g:
+        g.db = SessionLocal()
+    return g.db
+
+
+@app.teardown_request
+def close_db(exc=None):
+    db = g.pop("db", None)
+    if db is not None:
+        db.close()
+
+
 @app.route("/health")
 def health():
     try:
@@ -79,15 +168,11 @@ app.logger.info("Flask DB URL: %s", engine.url)
 # -------------------------
 def get_or_create_user(db, tg_user: dict):
     """
-    Create user if not exists.
+    Create user if not exists (refreshing username / first_name if it does),
+    in one INSERT ... ON CONFLICT round trip; the caller commits.
     tg_user = {id, first_name, username}
     """
-    user = db.query(User).filter(User.id == tg_user["id"]).first()
-
-    if user:
-        return user
-
-    user = User(
+    stmt = pg_insert(User).values(
         id=tg_user["id"],
         first_name=tg_user.get("first_name"),
         username=tg_user.get("username"),
@@ -97,13 +182,15 @@ def get_or_create_user(db, tg_user: dict):
         balance_mstc=0.0,
         total_team_business=0.0,
         active_origin_count=0,
-        created_at=datetime.utcnow(),
     )
-
-    db.add(user)
-    db.commit()
-    db.refresh(user)
-    return user
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[User.id],
+        set_={
+            "username": stmt.excluded.username,
+            "first_name": stmt.excluded.first_name,
+        },
+    ).returning(User)
+    return db.scalars(stmt, execution_options={"populate_existing": True}).one()
 
 @app.route("/debug/routes", methods=["GET"])
 def debug_routes():
@@ -121,7 +208,7 @@ def check_debug_key():
     Robust check for debug key. Accept header variants, query param 'debug_key' or 'key',
     and strip whitespace before comparing.
     """
-    expected = current_app.config.get("DEBUG_KEY") or os.getenv("DEBUG_KEY")
+    expected = current_app.config.get("DEBUG_KEY") or _debug_key
     if not expected:
         current_app.logger.warning("check_debug_key: DEBUG_KEY not set in config or env")
         return False
@@ -166,36 +253,96 @@ def link_referrer_if_needed(db, user: User, maybe_referrer_id: int | None):
     if not ref:
         return
     user.referrer_id = ref.id
-    db.commit()
-    db.refresh(user)
 
-def get_uplines(db, user, max_levels=3):
-    uplines = []
-    current = user
-    level = 1
-    while level <= max_levels and getattr(current, 'referrer_id', None):
-        upline = db.get(User, current.referrer_id)
-        if not upline:
-            break
-        uplines.append((level, upline))
-        current = upline
-        level += 1
-    return uplines
+def _parse_init_data(init_data: str) -> Optional[dict]:
+    """
+    Split initData ("key=value&..." with percent-encoded values) into a dict.
+    Telegram sends a handful of plain ASCII keys, so a split/partition pass
+    is enough; returns None for a pair without "=" like strict parse_qsl.
+    """
+    data = {}
+    for pair in init_data.split("&"):
+        key, sep, value = pair.partition("=")
+        if not sep:
+            return None
+        data[key] = unquote_plus(value)
+    return data
+
+# Verification results keyed by a digest of the initData string. The mini app
+# posts the same initData to several endpoints as it loads, so repeats within
+# the TTL skip the parse + HMAC + JSON decode.
+INIT_DATA_CACHE_TTL = 30  # seconds
+INIT_DATA_CACHE_SIZE = 1024
+_init_data_cache = OrderedDict()
+_init_data_cache_lock = threading.Lock()
+
+def _refresh_secret_key(token: Optional[str] = None):
+    """
+    Re-derive the initData secret after a bot token rotation (default: re-read
+    BOT_TOKEN from the environment) and drop results cached under the old key.
+    """
+    global BOT_TOKEN, _TELEGRAM_SECRET_KEY
+    BOT_TOKEN = token if token is not None else os.getenv("BOT_TOKEN")
+    _TELEGRAM_SECRET_KEY = (
+        hmac.new(b"WebAppData", BOT_TOKEN.encode(), hashlib.sha256).digest()
+        if BOT_TOKEN else None
+    )
+    with _init_data_cache_lock:
+        _init_data_cache.clear()
 
 def verify_telegram_init_data(init_data: str):
-    if not init_data:
-        return None, None, None, None
-    try:
-        data = dict(parse_qsl(init_data, strict_parsing=True))
-    except Exception:
-        return None, None, None, None
+    """
+    Return (id, username, first_name, start_param) for valid initData,
+    or None so callers can reject with a single truthiness check.
+    """
+    if not isinstance(init_data, str) or not init_data or len(init_data) > MAX_INIT_DATA_LENGTH:
+        return None
+
+    key = hashlib.blake2b(init_data.encode(), digest_size=16).digest()
+    now = time.monotonic()
+    with _init_data_cache_lock:
+        cached = _init_data_cache.get(key)
+        if cached is not None and cached[0] > now:
+            _init_data_cache.move_to_end(key)
+            return cached[1]
+
+    result = _verify_telegram_init_data(init_data)
+
+    with _init_data_cache_lock:
+        _init_data_cache[key] = (now + INIT_DATA_CACHE_TTL, result)
+        _init_data_cache.move_to_end(key)
+        while len(_init_data_cache) > INIT_DATA_CACHE_SIZE:
+            _init_data_cache.popitem(last=False)
+    return result
+
+def _verify_telegram_init_data(init_data: str):
+    data = _parse_init_data(init_data)
+    if data is None:
+        return None
+    if _TELEGRAM_SECRET_KEY is not None:
+        try:
+            received_hash = bytes.fromhex(data.pop("hash", ""))
+        except ValueError:
+            return None
+        if not received_hash:
+            return None
+        data_check_string = "\n".join(f"{key}={value}" for key, value in sorted(data.items()))
+        # one-shot C implementation (OpenSSL HMAC), no hmac.HMAC object;
+        # compared as raw digest bytes, no hex string built
+        calculated_hash = hmac.digest(
+            _TELEGRAM_SECRET_KEY, data_check_string.encode(), "sha256"
+        )
+        if not hmac.compare_digest(calculated_hash, received_hash):
+            return None
     user_str = data.get("user")
     if not user_str:
-        return None, None, None, None
+        return None
     try:
-        user = json.loads(user_str)
-    except Exception:
-        return None, None, None, None
+        user = orjson.loads(user_str)
+    except orjson.JSONDecodeError:
+        return None
+    if not user.get("id"):
+        return None
     start_param = data.get("start_param")
     return user.get("id"), user.get("username"), user.get("first_name"), start_param
 
@@ -203,23 +350,48 @@ def verify_telegram_init_data(init_data: str):
 # Business helpers
 # -------------------------
 
+ADMIN_ROLES = frozenset({"admin", "superadmin"})
+
+# Ranks that share the 2% club bonus
+CLUB_ROLES = frozenset({"life_changer", "advisor", "visionary", "creator"})
+
 def require_admin(user):
-    return user and user.role in ("admin", "superadmin")
+    return user and user.role in ADMIN_ROLES
+
+# Team business needed for each rank, lowest first; life_changer also needs
+# LIFE_CHANGER_MIN_ORIGINS active origins. update_rank() and the bulk SQL
+# CASE are both built from this one table.
+_RANK_THRESHOLDS = (1000, 5000, 25000, 100000)
+_RANK_NAMES = (None, "life_changer", "advisor", "visionary", "creator")
+LIFE_CHANGER_MIN_ORIGINS = 10
 
 def update_rank(user: User):
     total = user.total_team_business or 0.0
-    active_origins = user.active_origin_count or 0
-
-    if total >= 100000:
-        user.role = "creator"
-    elif total >= 25000:
-        user.role = "visionary"
-    elif total >= 5000:
-        user.role = "advisor"
-    elif total >= 1000 and active_origins >= 10:
-        user.role = "life_changer"
+    tier = bisect_right(_RANK_THRESHOLDS, total)
+
+    if tier == 1 and (user.active_origin_count or 0) < LIFE_CHANGER_MIN_ORIGINS:
+        tier = 0
+    if tier:
+        new_role = _RANK_NAMES[tier]
     elif user.self_activated and user.role == "user":
-        user.role = "origin"
+        new_role = "origin"
+    else:
+        return
+    # only touch the attribute on an actual rank change, so a stable rank
+    # leaves nothing for the unit of work to diff or flush
+    if user.role != new_role:
+        user.role = new_role
+
+def _rank_case(total, active_origins):
+    """SQL CASE mirroring update_rank(), built from the same threshold table."""
+    whens = []
+    for threshold, name in zip(reversed(_RANK_THRESHOLDS), reversed(_RANK_NAMES[1:])):
+        cond = total >= threshold
+        if name == "life_changer":
+            cond = cond & (active_origins >= LIFE_CHANGER_MIN_ORIGINS)
+        whens.append((cond, name))
+    whens.append(((User.self_activated == True) & (User.role == "user"), "origin"))
+    return case(*whens, else_=User.role)
 
 ROLE_LEVEL1_PCT = {
     "origin": 0.05,
@@ -229,45 +401,95 @@ ROLE_LEVEL1_PCT = {
     "creator": 0.25,
 }
 
+# Hard ceiling on how far up a referral chain is followed
+UPLINE_MAX_DEPTH = 64
+
+# Ancestors of :uid, nearest first. The CYCLE clause stops the recursion as
+# soon as an id repeats, so a looped referral chain yields each ancestor once;
+# :max_depth stops the walk after that many levels.
+_UPLINE_IDS_SQL = text("""
+    WITH RECURSIVE uplines(id, referrer_id, depth) AS (
+        SELECT u.id, u.referrer_id, 1
+        FROM users u
+        WHERE u.id = (SELECT referrer_id FROM users WHERE id = :uid)
+        UNION ALL
+        SELECT u.id, u.referrer_id, p.depth + 1
+        FROM users u
+        JOIN uplines p ON u.id = p.referrer_id
+        WHERE p.depth < :max_depth
+    ) CYCLE id SET is_cycle USING path
+    SELECT id, depth FROM uplines
+    WHERE NOT is_cycle
+    ORDER BY depth
+""")
+
+# The same walk as a subquery, so reads can join users to it and writes to the
+# whole upline can filter on "id IN (...)" without fetching the ids first.
+_UPLINES_SUBQUERY = _UPLINE_IDS_SQL.columns(
+    column("id", BigInteger), column("depth", Integer)
+).subquery("upline_ids")
+
+_FETCH_UPLINES_STMT = (
+    select(User)
+    .join(_UPLINES_SUBQUERY, User.id == _UPLINES_SUBQUERY.c.id)
+    .order_by(_UPLINES_SUBQUERY.c.depth)
+)
+
+def fetch_uplines(db, user_id: int, max_levels: int = UPLINE_MAX_DEPTH) -> list[User]:
+    """Ancestors of user_id, nearest first, walked and loaded in one query."""
+    params = {"uid": user_id, "max_depth": min(max_levels, UPLINE_MAX_DEPTH)}
+    return list(db.scalars(_FETCH_UPLINES_STMT, params))
+
+def get_uplines(db, user, max_levels=3):
+    if not getattr(user, 'referrer_id', None):
+        return []
+    return list(enumerate(fetch_uplines(db, user.id, max_levels), start=1))
+
 def propagate_team_business(db: SessionLocal, user: User, amount: float, became_origin_now: bool):
-    visited = set()
-    current = user
-    while getattr(current, 'referrer_id', None) and current.referrer_id not in visited:
-        ref = db.get(User, current.referrer_id)
-        if not ref:
-            break
-        visited.add(ref.id)
-        ref.total_team_business = (ref.total_team_business or 0.0) + amount
-        if became_origin_now:
-            ref.active_origin_count = (ref.active_origin_count or 0) + 1
-        update_rank(ref)
-        db.add(ref)
-        current = ref
+    if not user.referrer_id:
+        return
+    # SET expressions all see the pre-update row, so the rank CASE is fed the
+    # new totals explicitly and everything, CTE walk included, is one statement.
+    new_total = User.total_team_business + amount
+    new_origins = User.active_origin_count + (1 if became_origin_now else 0)
+    db.execute(
+        update(User)
+        .where(User.id.in_(select(_UPLINES_SUBQUERY.c.id)))
+        .values(
+            total_team_business=new_total,
+            active_origin_count=new_origins,
+            role=_rank_case(new_total, new_origins),
+        )
+        .execution_options(synchronize_session=False),
+        {"uid": user.id, "max_depth": UPLINE_MAX_DEPTH},
+    )
+
+# Built once so SQLAlchemy's compiled-statement cache is hit on every deposit
+_CLUB_ACHIEVER_FILTER = (
+    User.self_activated == True,
+    User.role.in_(CLUB_ROLES),
+)
+_CLUB_ACHIEVER_COUNT_STMT = select(func.count(User.id)).where(*_CLUB_ACHIEVER_FILTER)
 
 def distribute_club_bonus(db: SessionLocal, amount: float) -> float:
     club_cut = round(amount * 0.02, 2)
     if club_cut <= 0:
         return 0.0
-    achievers = (
-        db.query(User)
-        .filter(
-            User.self_activated == True,
-            User.role.in_( ["life_changer", "advisor", "visionary", "creator"] )
-        )
-        .all()
-    )
-    if not achievers:
+    achiever_count = db.execute(_CLUB_ACHIEVER_COUNT_STMT).scalar() or 0
+    if not achiever_count:
         add_to_company_pool(db, club_cut)
         return club_cut
-    per_user = round(club_cut / len(achievers), 2)
+    per_user = round(club_cut / achiever_count, 2)
     if per_user <= 0:
         add_to_company_pool(db, club_cut)
         return club_cut
-    distributed_total = 0.0
-    for u in achievers:
-        u.club_income = float(u.club_income or 0.0) + per_user
-        db.add(u)
-        distributed_total += per_user
+    db.execute(
+        update(User)
+        .where(*_CLUB_ACHIEVER_FILTER)
+        .values(club_income=User.club_income + per_user)
+        .execution_options(synchronize_session=False)
+    )
+    distributed_total = per_user * achiever_count
     leftover = round(club_cut - distributed_total, 2)
     if leftover > 0:
         add_to_company_pool(db, leftover)
@@ -275,40 +497,45 @@ def distribute_club_bonus(db: SessionLocal, amount: float) -> float:
 
 COMPANY_USER_ID = -999999999
 
-def get_company_user(db: SessionLocal) -> User:
-    company = db.get(User, COMPANY_USER_ID)
-    if not company:
-        company = User(
-            id=COMPANY_USER_ID,
-            username="company_pool",
-            first_name="Company",
-            role="company",
-            self_activated=False,
-            created_at=datetime.utcnow(),
-            balance_musd=0.0,
-            balance_mstc=0.0,
-        )
-        db.add(company)
-        db.commit()
-        db.refresh(company)
-    return company
-
-def add_to_company_pool(db: SessionLocal, amount: float, *, commit: bool = False):
+def add_to_company_pool(db: SessionLocal, amount: float, *, commit: bool = False) -> None:
+    """
+    Credit the company pool in one statement, creating the company row with
+    the amount as its opening balance if it doesn't exist yet.
+    """
     amount = float(amount or 0.0)
     if amount <= 0:
         return
-    company = get_company_user(db)
-    company.balance_musd = float(company.balance_musd or 0.0) + amount
-    db.add(company)
+    stmt = pg_insert(User).values(
+        id=COMPANY_USER_ID,
+        username="company_pool",
+        first_name="Company",
+        role="company",
+        self_activated=False,
+        balance_musd=amount,
+        balance_mstc=0.0,
+    )
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=[User.id],
+        set_={"balance_musd": func.coalesce(User.balance_musd, 0) + amount},
+    ))
     if commit:
         db.commit()
-        db.refresh(company)
 
 # -------------------------
 # Routes
 # -------------------------
 
 DEPOSIT_API_KEY = os.getenv("DEPOSIT_API_KEY")
+BASE_URL = os.getenv("BASE_URL", "https://mstcbotnew-production.up.railway.app")
+WEBAPP_URL = f"{BASE_URL}/static/telegram_mini_app.html"
+
+# ADMIN_TELEGRAM_IDS=123456,789012
+ADMIN_TELEGRAM_IDS = frozenset(
+    int(x) for x in os.getenv("ADMIN_TELEGRAM_IDS", "").split(",") if x.strip().isdigit()
+)
+
+_BOT_START_RETURNING_MSG = "Welcome back, {}! Tap below to continue."
+_BOT_START_NEW_MSG = "Welcome {}! Tap below to register."
 
 @app.route("/", methods=["GET"])
 def home():
@@ -319,32 +546,28 @@ def webapp_me():
     payload = request.get_json(silent=True) or {}
     init_data = payload.get("initData")
 
-    telegram_id, _, _, _ = verify_telegram_init_data(init_data)
-    if not telegram_id:
+    tg_user = verify_telegram_init_data(init_data)
+    if not tg_user:
         return jsonify(ok=False, error="invalid_init_data"), 400
+    telegram_id = tg_user[0]
 
-    db = SessionLocal()
-    try:
-        user = db.query(User).filter(User.id == telegram_id).first()
-        if not user:
-            return jsonify(ok=False, not_registered=True)
-
-        return jsonify(
-            ok=True,
-            user={
-                "id": user.id,
-                "username": user.username,
-                "first_name": user.first_name,
-                "role": user.role,
-                "balance_mstc": float(user.balance_mstc or 0),
-                "balance_musd": float(user.balance_musd or 0),
-                "referrer_id": user.referrer_id,
-            }
-        )
+    db = get_db()
+    user = db.get(User, telegram_id)
+    if not user:
+        return jsonify(ok=False, not_registered=True)
 
-    
-    finally:
-        db.close()
+    return jsonify(
+        ok=True,
+        user={
+            "id": user.id,
+            "username": user.username,
+            "first_name": user.first_name,
+            "role": user.role,
+            "balance_mstc": float(user.balance_mstc or 0),
+            "balance_musd": float(user.balance_musd or 0),
+            "referrer_id": user.referrer_id,
+        }
+    )
 
 
 @app.route("/webapp/init", methods=["POST"])
@@ -355,32 +578,29 @@ def webapp_init():
     if not init_data:
         return jsonify(ok=False, error="missing_init_data"), 400
 
-    telegram_id, username, first_name, start_param = verify_telegram_init_data(init_data)
-    if not telegram_id:
+    tg_user = verify_telegram_init_data(init_data)
+    if not tg_user:
         return jsonify(ok=False, error="invalid_telegram_user"), 400
+    telegram_id = tg_user[0]
 
-    db = SessionLocal()
-    try:
-        user = db.query(User).filter(User.id == telegram_id).first()
-        if not user:
-            return jsonify(ok=True, exists=False)
-
-        return jsonify(
-            ok=True,
-            exists=True,
-            user={
-                "id": user.id,
-                "first_name": user.first_name,
-                "username": user.username,
-                "role": user.role,
-                "self_activated": user.self_activated,
-                "total_team_business": float(user.total_team_business or 0),
-                "active_origin_count": int(user.active_origin_count or 0),
-            }
-        )
+    db = get_db()
+    user = db.get(User, telegram_id)
+    if not user:
+        return jsonify(ok=True, exists=False)
 
-    finally:
-        db.close()
+    return jsonify(
+        ok=True,
+        exists=True,
+        user={
+            "id": user.id,
+            "first_name": user.first_name,
+            "username": user.username,
+            "role": user.role,
+            "self_activated": user.self_activated,
+            "total_team_business": float(user.total_team_business or 0),
+            "active_origin_count": int(user.active_origin_count or 0),
+        }
+    )
 
 
 from sqlalchemy.exc import OperationalError
@@ -393,16 +613,18 @@ def webapp_register():
     if not init_data:
         return jsonify(ok=False, error="missing_init_data"), 400
 
-    uid, username, first_name, _ = verify_telegram_init_data(init_data)
-    if not uid:
+    tg_user = verify_telegram_init_data(init_data)
+    if not tg_user:
         return jsonify(ok=False, error="invalid_init_data"), 400
+    uid, username, first_name, _ = tg_user
 
-    db = SessionLocal()
+    db = get_db()
     try:
         user = get_or_create_user(
             db,
             {"id": uid, "username": username, "first_name": first_name}
         )
+        db.commit()
 
         return jsonify(ok=True, user={
             "id": user.id,
@@ -416,28 +638,23 @@ def webapp_register():
         current_app.logger.exception("register failed")
         return jsonify(ok=False, error="server_error"), 500
 
-    finally:
-        db.close()
-
 
 @app.route("/webapp/user", methods=["POST"])
 def webapp_user():
     data = request.get_json(silent=True) or {}
     init_data = data.get("initData")
 
-    telegram_id, _, _, _ = verify_telegram_init_data(init_data)
-    if not telegram_id:
+    tg_user = verify_telegram_init_data(init_data)
+    if not tg_user:
         return jsonify(ok=False, error="invalid_init_data"), 400
+    telegram_id = tg_user[0]
 
-    db = SessionLocal()
+    db = get_db()
     try:
-        user = db.query(User).filter(User.id == telegram_id).first()
+        user = db.get(User, telegram_id)
         if not user:
             return jsonify(ok=False, error="user_not_found"), 404
 
-        admin_ids = os.getenv("ADMIN_TELEGRAM_IDS", "")
-        admin_set = {int(x) for x in admin_ids.split(",") if x.strip().isdigit()}
-
         return jsonify(
             ok=True,
             user={
@@ -448,7 +665,7 @@ def webapp_user():
                 "self_activated": bool(user.self_activated),
                 "total_team_business": float(user.total_team_business or 0),
                 "active_origin_count": int(user.active_origin_count or 0),
-                "is_admin": telegram_id in admin_set,
+                "is_admin": telegram_id in ADMIN_TELEGRAM_IDS,
             }
         )
 
@@ -456,9 +673,6 @@ def webapp_user():
         # 👈 THIS is the ONLY place DB warm handling belongs
         return jsonify(ok=False, error="db_temp_unavailable"), 503
 
-    finally:
-        db.close()
-
 
 @app.route("/admin/users", methods=["POST"])
 def admin_users():
@@ -472,53 +686,46 @@ def admin_users():
             "error": "missing_init_data"
         }), 400
 
-    uid, _, _, _ = verify_telegram_init_data(init_data)
-    if not uid:
+    tg_user = verify_telegram_init_data(init_data)
+    if not tg_user:
         return jsonify({
             "ok": False,
             "error": "unauthorized"
         }), 401
+    uid = tg_user[0]
 
    
-    db = SessionLocal()
-    try:
-        admin_user = (
-            db.query(User)
-            .filter(User.id == uid)
-            .first()
-        )
-
-        if not require_admin(admin_user):
-            return jsonify({
-                "ok": False,
-                "error": "forbidden"
-            }), 403
-
-        users = (
-            db.query(User)
-            .order_by(User.created_at.desc())
-            .limit(50)
-            .all()
-        )
+    db = get_db()
+    admin_user = db.get(User, uid)
 
+    if not require_admin(admin_user):
         return jsonify({
-            "ok": True,
-            "users": [
-                {
-                    "id": u.id,
-                    "username": u.username,
-                    "first_name": u.first_name,
-                    "role": u.role,
-                    "balance_musd": float(u.balance_musd or 0),
-                    "balance_mstc": float(u.balance_mstc or 0),
-                    "active": bool(u.active)
-                }
-                for u in users
-            ]
-        })
+            "ok": False,
+            "error": "forbidden"
+        }), 403
 
-    finally:
-        db.close()
+    users = (
+        db.query(User)
+        .order_by(User.created_at.desc())
+        .limit(50)
+        .all()
+    )
+
+    return jsonify({
+        "ok": True,
+        "users": [
+            {
+                "id": u.id,
+                "username": u.username,
+                "first_name": u.first_name,
+                "role": u.role,
+                "balance_musd": float(u.balance_musd or 0),
+                "balance_mstc": float(u.balance_mstc or 0),
+                "active": bool(u.active)
+            }
+            for u in users
+        ]
+    })
 
 @app.route("/admin/update_user", methods=["POST"])
 def admin_update_user():
@@ -534,93 +741,85 @@ def admin_update_user():
             "error": "missing_params"
         }), 400
 
-    admin_id, _, _, _ = verify_telegram_init_data(init_data)
-    if not admin_id:
+    tg_user = verify_telegram_init_data(init_data)
+    if not tg_user:
         return jsonify({
             "ok": False,
             "error": "unauthorized"
         }), 401
+    admin_id = tg_user[0]
 
     
-    db = SessionLocal()
-    try:
-        admin = (
-            db.query(User)
-            .filter(User.id == admin_id)
-            .first()
-        )
-
-        if not admin or admin.role not in ("admin", "superadmin"):
-            return jsonify({
-                "ok": False,
-                "error": "forbidden"
-            }), 403
+    db = get_db()
+    admin = db.get(User, admin_id)
 
-        user = (
-            db.query(User)
-            .filter(User.id == int(target_id))
-            .first()
-        )
-
-        if not user:
-            return jsonify({
-                "ok": False,
-                "error": "user_not_found"
-            }), 404
+    if not admin or admin.role not in ADMIN_ROLES:
+        return jsonify({
+            "ok": False,
+            "error": "forbidden"
+        }), 403
 
-        # -------- ACTIONS --------
-        if action == "promote":
-            user.role = "admin"
+    user = db.get(User, int(target_id))
 
-        elif action == "demote":
-            user.role = "user"
+    if not user:
+        return jsonify({
+            "ok": False,
+            "error": "user_not_found"
+        }), 404
 
-        elif action == "activate":
-            user.active = True
+    # -------- ACTIONS --------
+    if action == "promote":
+        user.role = "admin"
 
-        elif action == "deactivate":
-            user.active = False
+    elif action == "demote":
+        user.role = "user"
 
-        else:
-            return jsonify({
-                "ok": False,
-                "error": "invalid_action"
-            }), 400
+    elif action == "activate":
+        user.active = True
 
-        db.commit()
+    elif action == "deactivate":
+        user.active = False
 
+    else:
         return jsonify({
-            "ok": True,
-            "user": {
-                "id": user.id,
-                "role": user.role,
-                "active": bool(user.active)
-            }
-        })
+            "ok": False,
+            "error": "invalid_action"
+        }), 400
 
-    finally:
-        db.close()
+    db.commit()
+
+    return jsonify({
+        "ok": True,
+        "user": {
+            "id": user.id,
+            "role": user.role,
+            "active": bool(user.active)
+        }
+    })
 
 @app.route("/admin/impersonate", methods=["POST"])
 def admin_impersonate():
-   
-    db = SessionLocal()
-    try:
-        data = request.get_json() or {}
-        init_data = data.get("initData")
-        target_id = data.get("user_id")
+    data = request.get_json(silent=True) or {}
+    init_data = data.get("initData")
+    target_id = data.get("user_id")
 
-        if not init_data or not target_id:
-            return jsonify({"ok": False}), 400
+    if not init_data or not target_id:
+        return jsonify({"ok": False}), 400
 
-        admin_id, _, _, _ = verify_telegram_init_data(init_data)
-        admin = db.query(User).filter(User.id == admin_id).first()
+    tg_user = verify_telegram_init_data(init_data)
+    if not tg_user:
+        return jsonify({"ok": False, "error": "forbidden"}), 403
+    admin_id = tg_user[0]
+
+    db = get_db()
+    try:
+        admin = db.get(User, admin_id)
 
-        if not admin or admin.role not in ("admin", "superadmin"):
+        if not admin or admin.role not in ADMIN_ROLES:
             return jsonify({"ok": False, "error": "forbidden"}), 403
 
-        target = db.query(User).filter(User.id == target_id).first()
-        if not target or target.role in ("admin", "superadmin"):
+        target = db.get(User, target_id)
+        if not target or target.role in ADMIN_ROLES:
             return jsonify({"ok": False, "error": "cannot_impersonate"}), 400
 
         return jsonify({
@@ -636,8 +835,6 @@ def admin_impersonate():
     except Exception:
         logger.exception("admin_impersonate failed")
         return jsonify({"ok": False}), 500
-    finally:
-        db.close()
 
 @app.route("/admin/stats", methods=["POST"])
 def admin_stats():
@@ -651,89 +848,83 @@ def admin_stats():
             "error": "missing_init_data"
         }), 400
 
-    admin_id, _, _, _ = verify_telegram_init_data(init_data)
-    if not admin_id:
+    tg_user = verify_telegram_init_data(init_data)
+    if not tg_user:
         return jsonify({
             "ok": False,
             "error": "unauthorized"
         }), 401
+    admin_id = tg_user[0]
 
     
-    db = SessionLocal()
-    try:
-        admin = (
-            db.query(User)
-            .filter(User.id == admin_id)
-            .first()
-        )
-
-        if not admin or not require_admin(admin):
-            return jsonify({
-                "ok": False,
-                "error": "forbidden"
-            }), 403
+    db = get_db()
+    admin = db.get(User, admin_id)
 
-        # --------- STATS ----------
-        total_users = db.query(User).count()
+    if not admin or not require_admin(admin):
+        return jsonify({
+            "ok": False,
+            "error": "forbidden"
+        }), 403
 
-        active_users = (
-            db.query(User)
-            .filter(User.active.is_(True))
-            .count()
-        )
+    # --------- STATS ----------
+    total_users = db.query(User).count()
 
-        admin_count = (
-            db.query(User)
-            .filter(User.role.in_(("admin", "superadmin")))
-            .count()
-        )
+    active_users = (
+        db.query(User)
+        .filter(User.active.is_(True))
+        .count()
+    )
 
-        total_team_business = (
-            db.query(func.coalesce(func.sum(User.total_team_business), 0))
-            .scalar()
-        )
+    admin_count = (
+        db.query(User)
+        .filter(User.role.in_(ADMIN_ROLES))
+        .count()
+    )
 
-        total_musd_balance = (
-            db.query(func.coalesce(func.sum(User.balance_musd), 0))
-            .scalar()
-        )
+    total_team_business = (
+        db.query(func.coalesce(func.sum(User.total_team_business), 0))
+        .scalar()
+    )
 
-        today = datetime.utcnow().date()
+    total_musd_balance = (
+        db.query(func.coalesce(func.sum(User.balance_musd), 0))
+        .scalar()
+    )
 
-        today_deposits = (
-            db.query(func.coalesce(func.sum(Transaction.amount), 0))
-            .filter(func.date(Transaction.created_at) == today)
-            .scalar()
-        )
+    today = datetime.utcnow().date()
 
-        return jsonify({
-            "ok": True,
-            "stats": {
-                "total_users": int(total_users),
-                "active_users": int(active_users),
-                "admin_count": int(admin_count),
-                "total_team_business": float(total_team_business or 0),
-                "total_musd_balance": float(total_musd_balance or 0),
-                "today_deposits": float(today_deposits or 0),
-            }
-        })
+    today_deposits = (
+        db.query(func.coalesce(func.sum(Transaction.amount), 0))
+        .filter(func.date(Transaction.created_at) == today)
+        .scalar()
+    )
 
-    finally:
-        db.close()
+    return jsonify({
+        "ok": True,
+        "stats": {
+            "total_users": int(total_users),
+            "active_users": int(active_users),
+            "admin_count": int(admin_count),
+            "total_team_business": float(total_team_business or 0),
+            "total_musd_balance": float(total_musd_balance or 0),
+            "today_deposits": float(today_deposits or 0),
+        }
+    })
 
 @app.route("/webapp/save_wallet", methods=["POST"])
 def save_wallet():
-    db = SessionLocal()
-    try:
-        data = request.get_json()
-        init_data = data.get("initData")
-        ton_wallet = data.get("ton_wallet")
+    data = request.get_json(silent=True) or {}
+    init_data = data.get("initData")
+    ton_wallet = data.get("ton_wallet")
 
-        telegram_id, _, _, _ = verify_telegram_init_data(init_data)
-        if not telegram_id:
-            return jsonify({"ok": False, "error": "invalid_init_data"}), 400
+    tg_user = verify_telegram_init_data(init_data)
+    if not tg_user:
+        return jsonify({"ok": False, "error": "invalid_init_data"}), 400
+    telegram_id = tg_user[0]
 
-        user = db.query(User).filter(User.id == telegram_id).first()
+    db = get_db()
+    try:
+        user = db.get(User, telegram_id)
         if not user:
             return jsonify({"ok": False, "error": "user_not_found"}), 404
 
@@ -745,8 +936,6 @@ def save_wallet():
     except Exception:
         app.logger.exception("save_wallet error")
         return jsonify({"ok": False, "error": "server_error"}), 500
-    finally:
-        db.close()
 
 @app.post("/bot/start")
 def bot_start():
@@ -757,179 +946,156 @@ def bot_start():
 
     if not tg_id:
         return jsonify({"ok": False, "error": "missing_telegram_id"}), 400
-
-    db = SessionLocal()
     try:
-        # 🔒 READ ONLY — NO CREATE HERE
-        user = (
-            db.query(User)
-            .filter(User.telegram_id == int(tg_id))
-            .first()
-        )
-
-        if user:
-            message = f"Welcome back, {first_name or ''}! Tap below to continue."
-            button_label = "Open Deposit Mini App"
-        else:
-            message = f"Welcome {first_name or ''}! Tap below to register."
-            button_label = "Register / Open Mini App"
+        tg_id = int(tg_id)
+    except (TypeError, ValueError):
+        return jsonify({"ok": False, "error": "invalid_telegram_id"}), 400
 
-        webapp_url = (
-            f"{os.getenv('BASE_URL', 'https://mstcbotnew-production.up.railway.app')}"
-            "/static/telegram_mini_app.html"
-        )
+    db = get_db()
+    # 🔒 READ ONLY — NO CREATE HERE
+    # users.id is the Telegram id, so this is a primary-key lookup
+    user = db.get(User, tg_id)
 
-        return jsonify({
-            "ok": True,
-            "message": message,
-            "button_label": button_label,
-            "webapp_url": webapp_url,
-        })
+    if user:
+        message = _BOT_START_RETURNING_MSG.format(first_name or "")
+        button_label = "Open Deposit Mini App"
+    else:
+        message = _BOT_START_NEW_MSG.format(first_name or "")
+        button_label = "Register / Open Mini App"
 
-    finally:
-        db.close()
+    return jsonify({
+        "ok": True,
+        "message": message,
+        "button_label": button_label,
+        "webapp_url": WEBAPP_URL,
+    })
 
 @app.route("/webapp/profile", methods=["POST"])
 def webapp_profile():
-    
-    db = SessionLocal()
-    try:
-        data = request.get_json() or {}
-        init_data = data.get("initData")
+    data = request.get_json(silent=True) or {}
+    init_data = data.get("initData")
 
-        uid, _, _, _ = verify_telegram_init_data(init_data)
-        if not uid:
-            return jsonify({"ok": False}), 401
+    tg_user = verify_telegram_init_data(init_data)
+    if not tg_user:
+        return jsonify({"ok": False}), 401
+    uid = tg_user[0]
 
-        user = db.query(User).filter(User.id == uid).first()
-        if not user:
-            return jsonify({"ok": False}), 404
+    db = get_db()
+    user = db.get(User, uid)
+    if not user:
+        return jsonify({"ok": False}), 404
 
-        return jsonify({
-            "ok": True,
-            "user": {
-                "id": user.id,
-                "first_name": user.first_name,
-                "username": user.username,
-                "role": user.role,
-                "balance_mstc": float(user.balance_mstc),
-                "balance_musd": float(user.balance_musd),
-                "total_team_business": float(user.total_team_business),
-                "active_origin_count": user.active_origin_count
-            }
-        })
-    finally:
-        db.close()
+    return jsonify({
+        "ok": True,
+        "user": {
+            "id": user.id,
+            "first_name": user.first_name,
+            "username": user.username,
+            "role": user.role,
+            "balance_mstc": float(user.balance_mstc),
+            "balance_musd": float(user.balance_musd),
+            "total_team_business": float(user.total_team_business),
+            "active_origin_count": user.active_origin_count
+        }
+    })
 
 @app.route("/webapp/downlines", methods=["POST"])
 def webapp_downlines():
-    
-    db = SessionLocal()
-    try:
-        data = request.get_json() or {}
-        init_data = data.get("initData")
-
-        uid, _, _, _ = verify_telegram_init_data(init_data)
-        if not uid:
-            return jsonify({"ok": False}), 401
-
-        downlines = db.query(User).filter(User.referrer_id == uid).all()
+    data = request.get_json(silent=True) or {}
+    init_data = data.get("initData")
 
-        return jsonify({
-            "ok": True,
-            "downlines": [
-                {
-                    "id": u.id,
-                    "first_name": u.first_name,
-                    "username": u.username,
-                    "role": u.role,
-                    "team_business": float(u.total_team_business)
-                } for u in downlines
-            ]
-        })
-    finally:
-        db.close()
+    tg_user = verify_telegram_init_data(init_data)
+    if not tg_user:
+        return jsonify({"ok": False}), 401
+    uid = tg_user[0]
+
+    db = get_db()
+    downlines = db.query(User).filter(User.referrer_id == uid).all()
+
+    return jsonify({
+        "ok": True,
+        "downlines": [
+            {
+                "id": u.id,
+                "first_name": u.first_name,
+                "username": u.username,
+                "role": u.role,
+                "team_business": float(u.total_team_business)
+            } for u in downlines
+        ]
+    })
 
 @app.route("/webapp/role", methods=["POST"])
 def webapp_role():
-    
-    db = SessionLocal()
-    try:
-        data = request.get_json() or {}
-        init_data = data.get("initData")
+    data = request.get_json(silent=True) or {}
+    init_data = data.get("initData")
 
-        uid, _, _, _ = verify_telegram_init_data(init_data)
-        if not uid:
-            return jsonify({"ok": False}), 401
+    tg_user = verify_telegram_init_data(init_data)
+    if not tg_user:
+        return jsonify({"ok": False}), 401
+    uid = tg_user[0]
 
-        user = db.query(User).filter(User.id == uid).first()
-        if not user:
-            return jsonify({"ok": False}), 404
+    db = get_db()
+    user = db.get(User, uid)
+    if not user:
+        return jsonify({"ok": False}), 404
 
-        return jsonify({
-            "ok": True,
-            "role": user.role,
-            "active_origin_count": user.active_origin_count,
-            "total_team_business": float(user.total_team_business)
-        })
-    finally:
-        db.close()
+    return jsonify({
+        "ok": True,
+        "role": user.role,
+        "active_origin_count": user.active_origin_count,
+        "total_team_business": float(user.total_team_business)
+    })
 
 # -------------------------
 # Debug / admin endpoints
 # -------------------------
 
+# Columns shown for a user and each of its direct downlines
+_DOWNLINE_COLUMNS = (
+    User.id,
+    User.first_name,
+    User.username,
+    User.role,
+    User.self_activated,
+    User.referrer_id,
+    User.total_team_business,
+)
+_DEBUG_DOWNLINES_USER_STMT = select(*_DOWNLINE_COLUMNS).where(User.id == bindparam("user_id"))
+_DEBUG_DOWNLINES_STMT = select(*_DOWNLINE_COLUMNS).where(User.referrer_id == bindparam("user_id"))
+
+def _downline_row_to_dict(row):
+    return {
+        "id": row.id,
+        "first_name": row.first_name,
+        "username": row.username,
+        "role": row.role,
+        "self_activated": bool(row.self_activated),
+        "referrer_id": row.referrer_id,
+        "total_team_business": float(row.total_team_business or 0),
+    }
+
 @app.route("/debug/downlines/<int:user_id>")
 def debug_downlines(user_id):
-  
-  db = SessionLocal()
-  try:
-        user = (
-            db.query(User)
-            .filter(User.id == user_id)
-            .first()
-        )
+    db = get_db()
+    params = {"user_id": user_id}
+    user = db.execute(_DEBUG_DOWNLINES_USER_STMT, params).first()
 
-        if not user:
-            return jsonify({
-                "ok": False,
-                "error": "user_not_found"
-            }), 404
+    if not user:
+        return jsonify({
+            "ok": False,
+            "error": "user_not_found"
+        }), 404
 
-        direct_downlines = (
-            db.query(User)
-            .filter(User.referrer_id == user_id)
-            .all()
-        )
+    direct_downlines = db.execute(_DEBUG_DOWNLINES_STMT, params).all()
 
-        return jsonify({
-            "ok": True,
-            "user": {
-                "id": user.id,
-                "first_name": user.first_name,
-                "username": user.username,
-                "role": user.role,
-                "self_activated": bool(user.self_activated),
-                "referrer_id": user.referrer_id,
-                "total_team_business": float(user.total_team_business or 0),
-            },
-            "direct_downlines": [
-                {
-                    "id": d.id,
-                    "first_name": d.first_name,
-                    "username": d.username,
-                    "role": d.role,
-                    "self_activated": bool(d.self_activated),
-                    "referrer_id": d.referrer_id,
-                    "total_team_business": float(d.total_team_business or 0),
-                }
-                for d in direct_downlines
-            ],
-            "direct_downline_count": len(direct_downlines),
-        })
+    return jsonify({
+        "ok": True,
+        "user": _downline_row_to_dict(user),
+        "direct_downlines": [_downline_row_to_dict(d) for d in direct_downlines],
+        "direct_downline_count": len(direct_downlines),
+    })
 
-  finally:
-        db.close()
 @app.route("/debug/link_referrer", methods=["POST"])
 def debug_link_referrer():
         
@@ -950,19 +1116,11 @@ def debug_link_referrer():
             "error": "cannot_self_refer"
         }), 400
 
-    db = SessionLocal()
+    db = get_db()
     try:
-        user = (
-            db.query(User)
-            .filter(User.id == user_id)
-            .first()
-        )
+        user = db.get(User, user_id)
 
-        referrer = (
-            db.query(User)
-            .filter(User.id == referrer_id)
-            .first()
-        )
+        referrer = db.get(User, referrer_id)
 
         if not user or not referrer:
             return jsonify({
@@ -998,45 +1156,54 @@ def debug_link_referrer():
             "error": "internal_error"
         }), 500
 
-    finally:
-        db.close()
+# Only the columns /debug/list_users returns, as plain rows (no ORM hydration)
+_DEBUG_LIST_USERS_STMT = select(
+    User.id,
+    User.username,
+    User.first_name,
+    User.self_activated,
+    User.referrer_id,
+    User.total_team_business,
+    User.active_origin_count,
+    User.role,
+)
 
 @app.route("/debug/list_users", methods=["GET"])
 def debug_list_users():
         
-    db = SessionLocal()
+    db = get_db()
     try:
-        users = db.query(User).all()
-
-        return jsonify(
-            ok=True,
-            users=[
-                {
-                    "id": u.id,
-                    "username": u.username,
-                    "first_name": u.first_name,
-                    "self_activated": bool(u.self_activated),
-                    "referrer_id": u.referrer_id,
-                    "total_team_business": float(u.total_team_business or 0),
-                    "active_origin_count": int(u.active_origin_count or 0),
-                    "role": u.role,
-                }
-                for u in users
-            ],
-        )
-
+        # server-side cursor, 500 rows at a time, streamed straight out
+        users = db.execute(_DEBUG_LIST_USERS_STMT.execution_options(yield_per=500))
     except Exception:
         app.logger.exception("debug_list_users failed")
         return jsonify(ok=False, error="server_error"), 500
-    finally:
-        db.close()
+
+    def generate():
+        yield '{"ok":true,"users":['
+        sep = ""
+        for u in users:
+            yield sep + app.json.dumps({
+                "id": u.id,
+                "username": u.username,
+                "first_name": u.first_name,
+                "self_activated": bool(u.self_activated),
+                "referrer_id": u.referrer_id,
+                "total_team_business": float(u.total_team_business or 0),
+                "active_origin_count": int(u.active_origin_count or 0),
+                "role": u.role,
+            })
+            sep = ","
+        yield "]}"
+
+    return app.response_class(stream_with_context(generate()), mimetype="application/json")
 
 @app.route("/debug/company_pool", methods=["GET"])
 def debug_company_pool():
         
-    db = SessionLocal()
+    db = get_db()
     try:
-        company = db.query(User).filter(User.id == COMPANY_USER_ID).first()
+        company = db.get(User, COMPANY_USER_ID)
 
         if not company:
             return jsonify(
@@ -1061,8 +1228,6 @@ def debug_company_pool():
     except Exception:
         app.logger.exception("debug_company_pool failed")
         return jsonify(ok=False, error="server_error"), 500
-    finally:
-        db.close()
 
 # Single, canonical debug simulate_deposit implementation
 @app.route("/debug/simulate_deposit", methods=["POST"])
@@ -1078,38 +1243,41 @@ def debug_simulate_deposit():
     except Exception:
         return jsonify(ok=False, error="missing_user_or_amount"), 400
 
-    db = SessionLocal()
+    db = get_db()
     try:
-        user = db.query(User).filter(User.id == tg_id).first()
-        if not user:
-            return jsonify(ok=False, error="user_not_found"), 404
-
-        became_origin_now = False
-
-        if amount >= 20:
-            if not user.self_activated:
-                user.self_activated = True
-            if user.role == "user":
-                user.role = "origin"
-                became_origin_now = True
-
-        user.total_team_business = float(user.total_team_business or 0) + amount
-        db.add(user)
-
-        propagate_team_business(db, user, amount, became_origin_now)
-        update_rank(user)
-
-        db.add(Transaction(
-            user_id=user.id,
-            amount=amount,
-            currency="MUSD",
-            type="deposit",
-            external_id=tx_musd,
-            created_at=datetime.utcnow(),
-        ))
-
-        db.commit()
-        db.refresh(user)
+        # One transaction for the whole deposit; the depositor's row is locked
+        # so concurrent deposits for the same user serialize instead of
+        # overwriting each other's total_team_business. Uplines are credited
+        # with server-side increments and need no lock.
+        with db.begin():
+            user = db.execute(
+                select(User).where(User.id == tg_id).with_for_update()
+            ).scalar_one_or_none()
+            if not user:
+                return jsonify(ok=False, error="user_not_found"), 404
+
+            became_origin_now = False
+
+            if amount >= 20:
+                if not user.self_activated:
+                    user.self_activated = True
+                if user.role == "user":
+                    user.role = "origin"
+                    became_origin_now = True
+
+            user.total_team_business += amount
+
+            propagate_team_business(db, user, amount, became_origin_now)
+            update_rank(user)
+
+            db.add(Transaction(
+                user_id=user.id,
+                amount=amount,
+                currency="MUSD",
+                type="deposit",
+                external_id=tx_musd,
+                created_at=datetime.utcnow(),
+            ))
 
         return jsonify(ok=True, user={"id": user.id, "role": user.role})
 
@@ -1119,35 +1287,40 @@ def debug_simulate_deposit():
         current_app.logger.exception("simulate_deposit failed")
         return jsonify(ok=False, error="server_error"), 500
 
-    finally:
-        db.close()
-
 
  
+# Only the columns /debug/user returns, as plain rows (no ORM hydration)
+_DEBUG_USER_STMT = select(
+    User.id,
+    User.username,
+    User.first_name,
+    User.self_activated,
+    User.role,
+    User.referrer_id,
+    User.total_team_business,
+).where(User.id == bindparam("user_id"))
+
 @app.route("/debug/user/<int:user_id>")
 def debug_user(user_id):
         
-    db = SessionLocal()
-    try:
-        user = db.query(User).filter(User.id == user_id).first()
-        if not user:
-            return jsonify(ok=False, exists=False)
-
-        return jsonify(
-            ok=True,
-            exists=True,
-            user={
-                "id": user.id,
-                "username": user.username,
-                "first_name": user.first_name,
-                "self_activated": bool(user.self_activated),
-                "role": user.role,
-                "referrer_id": user.referrer_id,
-                "total_team_business": float(user.total_team_business or 0),
-            },
-        )
-    finally:
-        db.close()
+    db = get_db()
+    user = db.execute(_DEBUG_USER_STMT, {"user_id": user_id}).first()
+    if user is None:
+        return jsonify(ok=False, exists=False)
+
+    return jsonify(
+        ok=True,
+        exists=True,
+        user={
+            "id": user.id,
+            "username": user.username,
+            "first_name": user.first_name,
+            "self_activated": bool(user.self_activated),
+            "role": user.role,
+            "referrer_id": user.referrer_id,
+            "total_team_business": float(user.total_team_business or 0),
+        },
+    )
 
 @app.route("/debug/reset_user/<int:user_id>", methods=["POST"])
 def debug_reset_user(user_id):
@@ -1156,9 +1329,9 @@ def debug_reset_user(user_id):
         return jsonify(ok=False, error="invalid_debug_key"), 401
 
     
-    db = SessionLocal()
+    db = get_db()
     try:
-        user = db.query(User).filter(User.id == user_id).first()
+        user = db.get(User, user_id)
         if not user:
             return jsonify(ok=False, error="user_not_found"), 404
 
@@ -1187,51 +1360,62 @@ def debug_reset_user(user_id):
         db.rollback()
         app.logger.exception("debug_reset_user failed")
         return jsonify(ok=False, error="server_error"), 500
-    finally:
-        db.close()
 
 @app.route("/debug/transactions/<int:user_id>", methods=["GET"])
 def debug_transactions(user_id):
         
-    db = SessionLocal()
-    try:
-        txs = (
-            db.query(Transaction)
-            .filter(Transaction.user_id == user_id)
-            .order_by(Transaction.created_at.desc())
-            .all()
-        )
+    db = get_db()
+    txs = (
+        db.query(Transaction)
+        .filter(Transaction.user_id == user_id)
+        .order_by(Transaction.created_at.desc())
+        .all()
+    )
 
-        return jsonify(
-            ok=True,
-            transactions=[
-                {
-                    "id": t.id,
-                    "user_id": t.user_id,
-                    "amount": float(t.amount or 0),
-                    "currency": t.currency,
-                    "type": t.type,
-                    "external_id": t.external_id,
-                    "created_at": t.created_at.isoformat(),
-                }
-                for t in txs
-            ],
-        )
-    finally:
-        db.close()
+    return jsonify(
+        ok=True,
+        transactions=[
+            {
+                "id": t.id,
+                "user_id": t.user_id,
+                "amount": float(t.amount or 0),
+                "currency": t.currency,
+                "type": t.type,
+                "external_id": t.external_id,
+                "created_at": t.created_at.isoformat(),
+            }
+            for t in txs
+        ],
+    )
 
  
+# Token passed as secret_token to setWebhook; Telegram echoes it back in the
+# X-Telegram-Bot-Api-Secret-Token header. Unset means the check is skipped.
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+_WEBHOOK_SECRET_BYTES = WEBHOOK_SECRET.encode() if WEBHOOK_SECRET else None
+
+# Replies to Telegram are sent from here so /webhook can return 200 without
+# waiting on api.telegram.org; Telegram retries updates that are slow to ack.
+_webhook_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="tg-webhook")
+
 @app.route("/webhook", methods=["POST"])
 def telegram_webhook():
+    # checked before the body is parsed, so forged requests cost next to nothing
+    if _WEBHOOK_SECRET_BYTES is not None:
+        received = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode()
+        if not hmac.compare_digest(received, _WEBHOOK_SECRET_BYTES):
+            return jsonify(ok=False), 401
+
     update = request.get_json(silent=True)
-    app.logger.info("Webhook update: %s", update)
+    if app.logger.isEnabledFor(logging.DEBUG):
+        app.logger.debug("Webhook update: %s", update)
 
     if not update:
         return jsonify(ok=False), 400
 
     try:
         from .telegram_bot import handle_command
-        handle_command(update)
+        _webhook_executor.submit(handle_command, update)
     except Exception:
         app.logger.exception("handle_command failed")
 
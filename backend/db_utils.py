@@ -35,10 +35,9 @@ def recompute_total_team_business(db, user_id):
         total = db.query(func.coalesce(func.sum(Transaction.amount), 0.0)).filter(
             Transaction.user_id.in_(descendant_ids), Transaction.type == 'activation'
         ).scalar() or 0.0
-    u = db.query(User).get(user_id)
+    u = db.get(User, user_id)
     if u:
         u.total_team_business = float(total)
-        db.add(u)
         db.commit()
     return float(total)
 
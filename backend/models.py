@@ -2,7 +2,7 @@ import os
 from datetime import datetime
 from sqlalchemy import (
     create_engine, Column, Integer, String, Float,
-    DateTime, ForeignKey, BigInteger, Boolean, Index
+    DateTime, ForeignKey, BigInteger, Boolean, Index, func
 )
 from sqlalchemy.orm import declarative_base, relationship, sessionmaker
 from dotenv import load_dotenv
@@ -13,13 +13,25 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise RuntimeError("DATABASE_URL is not set")
 
+# Per gunicorn worker; size so WEB_CONCURRENCY * (pool + overflow) stays under
+# the server's max_connections. LIFO reuse keeps the hot connections busy and
+# lets the idle tail age out through pool_recycle.
 engine = create_engine(
     DATABASE_URL,
     pool_pre_ping=True,
     pool_recycle=300,
+    pool_size=int(os.getenv("DB_POOL_SIZE", "20")),
+    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "10")),
+    pool_use_lifo=True,
+    query_cache_size=1200,
 )
 
-SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
+SessionLocal = sessionmaker(
+    bind=engine,
+    autocommit=False,
+    autoflush=False,
+    expire_on_commit=False,
+)
 Base = declarative_base()
 
 
@@ -31,15 +43,25 @@ class User(Base):
     first_name = Column(String)
     role = Column(String, default="user")
     self_activated = Column(Boolean, default=False)
-    total_team_business = Column(Float, default=0.0)
-    active_origin_count = Column(Integer, default=0)
+    total_team_business = Column(Float, nullable=False, default=0.0, server_default="0")
+    active_origin_count = Column(Integer, nullable=False, default=0, server_default="0")
     balance_musd = Column(Float, default=0.0)
     balance_mstc = Column(Float, default=0.0)
+    club_income = Column(Float, nullable=False, default=0.0, server_default="0")
     referrer_id = Column(BigInteger, ForeignKey("users.id"))
-    created_at = Column(DateTime, default=datetime.utcnow)
+    # stamped by Postgres, in UTC like the datetime.utcnow() values before it
+    created_at = Column(DateTime, server_default=func.timezone("utc", func.now()))
 
     referrer = relationship("User", remote_side=[id])
 
+    __table_args__ = (
+        # upline CTE and downline lookups walk referrer_id; its leading
+        # column covers what ix_users_referrer_id used to
+        Index("ix_users_referrer_self", "referrer_id", "self_activated"),
+        # club bonus achiever filter
+        Index("ix_users_role_active", "self_activated", "role"),
+    )
+
 
 class Transaction(Base):
     __tablename__ = "transactions"
@@ -1,10 +1,11 @@
 import os
 import sys
 import logging
-import asyncio
 
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
-from telegram import Bot
 from telegram import WebAppInfo, InlineKeyboardButton, InlineKeyboardMarkup
 
 # local helpers
@@ -22,21 +23,55 @@ if not BOT_TOKEN:
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-bot = Bot(token=BOT_TOKEN)
+TG_SEND_MESSAGE_URL = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
+
+# Shared keep-alive session: api.telegram.org connections (and their TLS
+# handshakes) are reused across messages instead of opened per send.
+tg_session = requests.Session()
+# Replies are sent from the webhook thread pool in backend.app, so keep one
+# pooled connection per worker thread rather than urllib3's default of 10.
+# Retry only re-attempts connection failures, where the request was never
+# sent. POST is not in urllib3's default allowed_methods, so a read error or a
+# stale keep-alive connection dropping mid-request is not retried and the
+# message is never delivered twice.
+tg_session.mount("https://", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=16,
+    max_retries=Retry(total=2, backoff_factor=0.1),
+))
+
+WEBAPP_URL = (
+    "https://mstcbotnew-production.up.railway.app/"
+    "static/telegram_mini_app.html"
+)
+
+# /start reply keyboard, already in Bot API form (send_message_safe passes
+# dicts through unchanged)
+START_MARKUP = InlineKeyboardMarkup([[
+    InlineKeyboardButton(
+        text="Open Deposit Mini App",
+        web_app=WebAppInfo(url=WEBAPP_URL)
+    )
+]]).to_dict()
 
 # -------------------------
-# Helper: safe async send
+# Helper: safe send
 # -------------------------
 def send_message_safe(**kwargs):
     """
     Safely send Telegram messages from sync Flask context
     """
+    reply_markup = kwargs.get("reply_markup")
+    if reply_markup is not None and not isinstance(reply_markup, dict):
+        kwargs["reply_markup"] = reply_markup.to_dict()
     try:
-        asyncio.run(bot.send_message(**kwargs))
-    except RuntimeError:
-        # If event loop already running
-        loop = asyncio.get_event_loop()
-        loop.create_task(bot.send_message(**kwargs))
+        resp = tg_session.post(TG_SEND_MESSAGE_URL, json=kwargs, timeout=5)
+        if not resp.ok:
+            logger.warning("sendMessage failed: %s %s", resp.status_code, resp.text)
+    except requests.RequestException as exc:
+        # Only the exception type: its message carries the request URL, and
+        # TG_SEND_MESSAGE_URL has the bot token in its path.
+        logger.warning("sendMessage request failed: %s", type(exc).__name__)
 
 # -------------------------
 # Command handler
@@ -55,7 +90,8 @@ def handle_command(update: dict):
         user_id = from_user.get("id")
         text = (msg.get("text") or "").strip()
 
-        logger.info("Received from %s: %s", user_id, text)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received from %s: %s", user_id, text)
 
         # Ignore non-commands
         if not text.startswith("/"):
@@ -67,24 +103,10 @@ def handle_command(update: dict):
         # /start
         # -------------------------
         if cmd == "/start":
-            text_to_send = "Welcome! Tap below to open the deposit mini app."
-
-            webapp_url = (
-                "https://mstcbotnew-production.up.railway.app/"
-                "static/telegram_mini_app.html"
-            )
-
-            keyboard = [[
-                InlineKeyboardButton(
-                    text="Open Deposit Mini App",
-                    web_app=WebAppInfo(url=webapp_url)
-                )
-            ]]
-
             send_message_safe(
                 chat_id=chat_id,
-                text=text_to_send,
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                text="Welcome! Tap below to open the deposit mini app.",
+                reply_markup=START_MARKUP,
             )
             return
 
@@ -6,6 +6,11 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+BASE_URL = os.getenv(
+    "BASE_URL",
+    "https://mstcbotnew-production.up.railway.app"
+).rstrip("/")
+
 # -------------------------
 # Backend HTTP helper
 # -------------------------
@@ -13,12 +18,7 @@ def call_backend(path, method="GET", json=None, headers=None):
     """
     Call backend API from Telegram bot
     """
-    base_url = os.getenv(
-        "BASE_URL",
-        "https://mstcbotnew-production.up.railway.app"
-    )
-
-    url = base_url.rstrip("/") + path
+    url = BASE_URL + path
 
     try:
         resp = requests.request(
@@ -37,19 +37,14 @@ def call_backend(path, method="GET", json=None, headers=None):
 # -------------------------
 # Admin helper
 # -------------------------
+ADMIN_TELEGRAM_IDS = frozenset(
+    int(x.strip())
+    for x in os.getenv("ADMIN_TELEGRAM_IDS", "").split(",")
+    if x.strip().isdigit()
+)
+
 def is_admin(telegram_id: int) -> bool:
     """
     Check if telegram_id is in ADMIN_TELEGRAM_IDS env variable
     """
-    admin_ids = os.getenv("ADMIN_TELEGRAM_IDS", "")
-
-    try:
-        admin_set = {
-            int(x.strip())
-            for x in admin_ids.split(",")
-            if x.strip().isdigit()
-        }
-    except Exception:
-        admin_set = set()
-
-    return int(telegram_id) in admin_set
+    return int(telegram_id) in ADMIN_TELEGRAM_IDS
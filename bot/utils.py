@@ -10,11 +10,9 @@ BACKEND_URL = os.getenv("BACKEND_URL", "http://127.0.0.1:8001")
 
 # Admin IDs (Telegram user IDs), optional.
 # You can set in .env as: ADMIN_IDS=123456,789012
-_admin_ids_env = os.getenv("ADMIN_IDS", "")
-if _admin_ids_env.strip():
-    ADMIN_IDS = {int(x) for x in _admin_ids_env.split(",") if x.strip().isdigit()}
-else:
-    ADMIN_IDS = set()
+ADMIN_IDS = frozenset(
+    int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip().isdigit()
+)
 
 
 def is_admin(user_id: int) -> bool:
@@ -0,0 +1,39 @@
+# Production server settings:
+#   gunicorn -c gunicorn_config.py backend.app:app
+#
+# The app is I/O-bound (Postgres round-trips, Telegram API calls), so workers
+# are gevent greenlet workers: a request waiting on a socket yields instead
+# of holding the worker.
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8001')}"
+
+# GUNICORN_WORKER_CLASS=gthread falls back to threads.
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gevent")
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+
+timeout = 30
+
+# Import backend.app once in the master and fork workers from it, instead of
+# every worker importing (and logging, and building its statements) on boot.
+preload_app = True
+
+if worker_class == "gevent":
+    # With preload_app the app (and requests -> ssl) is imported before the
+    # worker would patch, so patch here, ahead of that import.
+    from gevent import monkey
+    monkey.patch_all()
+
+    # psycopg2 is a C extension that blocks in libpq; the wait callback makes
+    # its socket waits cooperative so one slow query doesn't stall the worker.
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+
+def post_fork(server, worker):
+    # Pooled connections must never be shared across processes; drop any the
+    # master may have opened without closing them under it.
+    from backend.models import engine
+    engine.dispose(close=False)
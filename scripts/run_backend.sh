@@ -1,3 +1,3 @@
 
 export FLASK_APP=backend/app.py
-python backend/app.py run
+gunicorn -c gunicorn_config.py backend.app:app
@@ -0,0 +1,28 @@
+from sqlalchemy import text
+from backend.models import engine
+
+# Counters that are incremented server-side (col = col + :amount) and so
+# must never be NULL.
+COUNTER_COLUMNS = ("total_team_business", "active_origin_count", "club_income")
+
+def main():
+    print("=== CONNECTING TO DB ===")
+    print("DB URL:", engine.url)
+
+    with engine.connect() as conn:
+        for column in COUNTER_COLUMNS:
+            print(f"Backfilling {column}...")
+            conn.execute(text(f"UPDATE users SET {column} = 0 WHERE {column} IS NULL;"))
+
+            print(f"Setting DEFAULT 0 NOT NULL on {column}...")
+            conn.execute(text(
+                f"ALTER TABLE users ALTER COLUMN {column} SET DEFAULT 0, "
+                f"ALTER COLUMN {column} SET NOT NULL;"
+            ))
+
+        conn.commit()
+
+    print("=== DONE ===")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+from sqlalchemy import text
+from backend.models import engine
+
+def main():
+    print("=== CONNECTING TO DB ===")
+    print("DB URL:", engine.url)
+
+    with engine.connect() as conn:
+        # users.created_at is stamped by the database now (UTC, no tz)
+        print("Setting DEFAULT on users.created_at...")
+        conn.execute(text(
+            "ALTER TABLE users ALTER COLUMN created_at "
+            "SET DEFAULT timezone('utc', now());"
+        ))
+
+        conn.commit()
+
+    print("=== DONE ===")
+
+if __name__ == "__main__":
+    main()
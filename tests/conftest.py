@@ -0,0 +1,5 @@
+import os
+
+# backend.models refuses to import without a DATABASE_URL; nothing in these
+# tests connects to it.
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/mstcbot_test")
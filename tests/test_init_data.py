@@ -0,0 +1,90 @@
+import hashlib
+import hmac
+import json
+from urllib.parse import urlencode
+
+import pytest
+
+import backend.app as app_module
+
+BOT_TOKEN = "123456:TEST-TOKEN"
+USER = {"id": 42, "first_name": "Ada", "username": "ada"}
+
+
+def sign(fields, token=BOT_TOKEN):
+    """initData the way Telegram builds it: fields plus an HMAC of their sorted k=v lines."""
+    secret = hmac.new(b"WebAppData", token.encode(), hashlib.sha256).digest()
+    check_string = "\n".join(f"{k}={v}" for k, v in sorted(fields.items()))
+    digest = hmac.new(secret, check_string.encode(), hashlib.sha256).hexdigest()
+    return urlencode({**fields, "hash": digest})
+
+
+def fields(**extra):
+    return {
+        "auth_date": "1700000000",
+        "query_id": "AAHdF6IQAAAAAN0XohDhrOrc",
+        "user": json.dumps(USER, separators=(",", ":")),
+        **extra,
+    }
+
+
+@pytest.fixture(autouse=True)
+def secret_key():
+    previous = app_module.BOT_TOKEN
+    app_module._refresh_secret_key(BOT_TOKEN)
+    yield
+    app_module._refresh_secret_key(previous)
+
+
+def test_valid_init_data_verifies():
+    init_data = sign(fields(start_param="ref_7"))
+    assert app_module.verify_telegram_init_data(init_data) == (42, "ada", "Ada", "ref_7")
+
+
+def test_other_token_is_rejected():
+    assert app_module.verify_telegram_init_data(sign(fields(), token="999:OTHER")) is None
+
+
+def test_tampered_field_is_rejected():
+    init_data = sign(fields()).replace("auth_date=1700000000", "auth_date=1700000001")
+    assert app_module.verify_telegram_init_data(init_data) is None
+
+
+def test_non_hex_hash_is_rejected():
+    init_data = urlencode({**fields(), "hash": "not-a-hex-digest"})
+    assert app_module.verify_telegram_init_data(init_data) is None
+
+
+def test_missing_hash_is_rejected():
+    assert app_module.verify_telegram_init_data(urlencode(fields())) is None
+
+
+def test_empty_value_is_part_of_signed_data():
+    init_data = sign(fields(start_param=""))
+    assert app_module.verify_telegram_init_data(init_data) == (42, "ada", "Ada", "")
+
+
+def test_trailing_ampersand_is_rejected():
+    assert app_module.verify_telegram_init_data(sign(fields()) + "&") is None
+
+
+@pytest.mark.parametrize("init_data", [None, "", 123, "x" * (app_module.MAX_INIT_DATA_LENGTH + 1)])
+def test_unusable_input_is_rejected(init_data):
+    assert app_module.verify_telegram_init_data(init_data) is None
+
+
+def test_cached_result_expires_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(app_module.time, "monotonic", lambda: now[0])
+    init_data = sign(fields())
+    assert app_module.verify_telegram_init_data(init_data) is not None
+
+    # A rotated key without a cache flush: within the TTL the cached verdict
+    # is still served ...
+    monkeypatch.setattr(app_module, "_TELEGRAM_SECRET_KEY", b"rotated" * 4)
+    now[0] += app_module.INIT_DATA_CACHE_TTL - 1
+    assert app_module.verify_telegram_init_data(init_data) is not None
+
+    # ... and once it has expired the signature is checked again.
+    now[0] += 2
+    assert app_module.verify_telegram_init_data(init_data) is None
@@ -0,0 +1,64 @@
+import pytest
+from sqlalchemy import create_engine, select, text
+
+import backend.app as app_module
+from backend.models import User
+
+
+def expected_role(total, origins, self_activated, role):
+    """The rank ladder as originally written, before it was table-driven."""
+    if total >= 100000:
+        return "creator"
+    if total >= 25000:
+        return "visionary"
+    if total >= 5000:
+        return "advisor"
+    if total >= 1000 and origins >= 10:
+        return "life_changer"
+    if self_activated and role == "user":
+        return "origin"
+    return role
+
+
+TOTALS = [0, 999, 1000, 1001, 4999, 5000, 5001, 24999, 25000, 25001, 99999, 100000, 100001]
+CASES = [
+    (total, origins, self_activated, role)
+    for total in TOTALS
+    for origins in (0, 9, 10, 11)
+    for self_activated, role in ((False, "user"), (True, "user"), (True, "origin"), (True, "advisor"))
+]
+
+
+@pytest.mark.parametrize("total,origins,self_activated,role", CASES)
+def test_update_rank_matches_ladder(total, origins, self_activated, role):
+    user = User(
+        total_team_business=float(total),
+        active_origin_count=origins,
+        self_activated=self_activated,
+        role=role,
+    )
+    app_module.update_rank(user)
+    assert user.role == expected_role(total, origins, self_activated, role)
+
+
+def test_rank_case_matches_ladder():
+    engine = create_engine("sqlite://")
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE users (id INTEGER PRIMARY KEY, role VARCHAR, self_activated BOOLEAN,"
+            " total_team_business FLOAT, active_origin_count INTEGER)"
+        ))
+        conn.execute(
+            text("INSERT INTO users VALUES (:id, :role, :self_activated, :total, :origins)"),
+            [
+                {"id": i, "role": role, "self_activated": self_activated, "total": total, "origins": origins}
+                for i, (total, origins, self_activated, role) in enumerate(CASES)
+            ],
+        )
+        rows = conn.execute(
+            select(User.id, app_module._rank_case(User.total_team_business, User.active_origin_count))
+        ).all()
+
+    assert len(rows) == len(CASES)
+    for user_id, rank in rows:
+        assert rank == expected_role(*CASES[user_id]), CASES[user_id]